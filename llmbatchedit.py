@@ -1,4 +1,4 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 import argparse
 import sys
 from pathlib import Path
@@ -8,6 +8,7 @@ import traceback
 from llmbatcheditor.LLMRunError import LLMRunError
 from llmbatcheditor.LLMEndPoint import LLMEndPoint
 from llmbatcheditor.LLMEndPointCached import LLMEndPointCached
+from llmbatcheditor.RateLimiter import RateLimiter
 
 from llmbatcheditor.InstructionParser import InstructionParser
 from llmbatcheditor.LoggerManager import LoggerManager
@@ -15,7 +16,7 @@ from llmbatcheditor.ContextManager import ContextManager
 from llmbatcheditor.MacroResolver import MacroResolver
 from llmbatcheditor.CommandExecutor import CommandExecutor
 
-def parse_command_ids(command_ids: List[str], commands: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def parse_command_ids(command_ids: List[str], commands: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], ...]:
     """
     Parses command IDs from the command line arguments.
 
@@ -28,99 +29,102 @@ def parse_command_ids(command_ids: List[str], commands: List[Dict[str, Any]]) ->
 
     :param command_ids: List of command ID strings from command line.
     :param commands: List of command dictionaries from the instruction file. Each dictionary must have a unique 'id' key.
-    :return: List of command dictionaries that match the provided IDs.
+    :return: Tuple of command dictionaries that match the provided IDs, in execution order.
     :raises ValueError: If any provided command ID is invalid or if a range is improperly specified.
     """
-    # Ensure all command IDs are unique to prevent unexpected behavior
-    seen_ids = set()
-    for cmd in commands:
+    # Map each command ID to its position in commands, used both to look IDs up and to slice ranges,
+    # ensuring all command IDs are unique to prevent unexpected behavior
+    index_of = {}
+    for i, cmd in enumerate(commands):
         cmd_id = cmd.get('id')
-        if cmd_id in seen_ids:
+        if cmd_id in index_of:
             raise ValueError(f"Duplicate command ID found in commands list: '{cmd_id}'. Command IDs must be unique.")
-        seen_ids.add(cmd_id)
-
-    # Create a lookup dictionary for quick access to commands by their ID
-    command_lookup = {cmd['id']: cmd for cmd in commands}
-    command_keys = list(command_lookup.keys())  # Preserves the order of commands
-    selected_commands = []
-    selected_ids = set()  # To avoid duplicates
+        index_of[cmd_id] = i
+    # Selected commands in selection order, duplicates are dropped once at the end
+    selected = []
 
     for cid in command_ids:
         cid = cid.strip()  # Remove any leading/trailing whitespace
-        if '-' in cid and not cid.startswith('-') and not cid.endswith('-'):
+        # Split on the first '-' in the same scan that looks for it
+        head, sep, tail = cid.partition('-')
+        if sep and head and not cid.endswith('-'):
             # Handle ranges, e.g., 'cmd1-cmd3' or 'cmd1 - cmd3'
-            parts = cid.split('-', 1)
-            if len(parts) != 2:
-                raise ValueError(f"Invalid range format: '{cid}'. Expected format 'start_id-end_id'.")
-            start_id, end_id = [part.strip() for part in parts]
+            start_id, end_id = head.strip(), tail.strip()
 
             # Check if both start_id and end_id exist
-            if start_id not in command_lookup and end_id not in command_lookup:
+            if start_id not in index_of and end_id not in index_of:
                 raise ValueError(f"Invalid range: both '{start_id}' and '{end_id}' are not valid command IDs.")
-            if start_id not in command_lookup:
+            if start_id not in index_of:
                 raise ValueError(f"Invalid range: start ID '{start_id}' does not exist.")
-            if end_id not in command_lookup:
+            if end_id not in index_of:
                 raise ValueError(f"Invalid range: end ID '{end_id}' does not exist.")
 
             # Get indices of start and end IDs
-            start_index = command_keys.index(start_id)
-            end_index = command_keys.index(end_id)
+            start_index = index_of[start_id]
+            end_index = index_of[end_id]
 
             if start_index > end_index:
                 raise ValueError(f"Invalid range: in '{cid}', start ID '{start_id}' comes after end ID '{end_id}'.")
 
             # Add commands in the specified range
-            for cmd in commands[start_index:end_index + 1]:
-                if cmd['id'] not in selected_ids:
-                    selected_commands.append(cmd)
-                    selected_ids.add(cmd['id'])
+            selected.extend(commands[start_index:end_index + 1])
 
         elif cid == '*':
-            # Handle '*' to select all commands
-            for cmd in commands:
-                if cmd['id'] not in selected_ids:
-                    selected_commands.append(cmd)
-                    selected_ids.add(cmd['id'])
+            # Handle '*' to select all commands, in instruction file order when nothing was selected before it
+            if not selected:
+                return tuple(commands)
+            selected.extend(commands)
             break  # No need to process further as all commands are selected
 
         elif cid.endswith('*') and len(cid) > 1:
             # Handle 'cmd1*' to select all commands from 'cmd1' to the end
             start_id = cid[:-1].strip()
-            if start_id not in command_lookup:
+            if start_id not in index_of:
                 raise ValueError(f"Invalid wildcard command ID: '{cid}'. Start ID '{start_id}' does not exist.")
 
-            start_index = command_keys.index(start_id)
+            start_index = index_of[start_id]
 
-            for cmd in commands[start_index:]:
-                if cmd['id'] not in selected_ids:
-                    selected_commands.append(cmd)
-                    selected_ids.add(cmd['id'])
+            selected.extend(commands[start_index:])
             break  # Wildcard selects all from start_id onwards
 
-        elif cid in command_lookup:
+        elif cid in index_of:
             # Handle exact command ID matches
-            if cid not in selected_ids:
-                selected_commands.append(command_lookup[cid])
-                selected_ids.add(cid)
+            selected.append(commands[index_of[cid]])
         else:
             # Invalid command ID
             raise ValueError(f"Invalid command ID: '{cid}'. Please provide a valid command ID from the instruction file.")
 
-    return selected_commands
+    # Drop duplicates, each command keeps the position it was first selected at
+    return tuple({cmd['id']: cmd for cmd in selected}.values())
 
 def main():
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Execute LLM-based commands from an instruction TOML file.")
-    parser.add_argument("instruction_file", type=str, help="Path to the instructions.toml file.")
+    parser.add_argument("instruction_file", type=lambda path: Path(path).resolve(), help="Path to the instructions.toml file.")
     parser.add_argument("command_ids", type=str, nargs='+', help="Command IDs to execute. Supports multiple IDs separated by spaces (e.g., 'create_converteggstocsv another_command').")
     parser.add_argument("--debug", action="store_true", help="Enable debug logging to console.")
+    parser.add_argument("--dry-run", action="store_true", help="Validate the instruction file and print the selected commands without running them.")
+    parser.add_argument("--no-cache", action="store_true", help="Send every prompt to the LLM instead of using cached responses. New responses are still cached.")
+    parser.add_argument("--cache-ttl", type=float, default=None, help="Maximum age in seconds of a cached response. Older responses are requested again.")
+    parser.add_argument("--cache-dir", type=Path, default=None, help="Directory of the response cache. Defaults to a per instruction file directory; share one directory to reuse responses across instruction files.")
+    parser.add_argument("--max-workers", type=int, default=None, help="Maximum number of files processed in parallel per command. Overrides 'max_workers' in the instruction file defaults (default: 3).")
     args = parser.parse_args()
 
-    instruction_path = Path(args.instruction_file).resolve()
+    instruction_path = args.instruction_file
     if not instruction_path.is_file():
         print(f"Error: Instruction file '{instruction_path}' does not exist.")
         sys.exit(1)
 
+    if args.max_workers is not None and args.max_workers <= 0:
+        print("Error: --max-workers must be a positive integer.")
+        sys.exit(1)
+
+    if args.cache_ttl is not None and args.cache_ttl < 0:
+        print("Error: --cache-ttl must not be negative.")
+        sys.exit(1)
+
+    logger_manager = None
+    llm_end_point = None
     try:
         # Initialize LoggerManager with a log directory based on instruction file name
         output_dir = Path(f"./.{Path(__file__).stem}/{instruction_path.stem}")
@@ -131,30 +135,47 @@ def main():
         # Parse and validate instruction file
         parser_obj = InstructionParser(instruction_path)
         data = parser_obj.get_data()
+        defaults = parser_obj.defaults
+
+        # Parse command_ids and map to commands, before anything else is set up so bad IDs fail fast
+        commands = data.get("commands", [])
+        if not commands:
+            raise LLMRunError("No commands found in the instruction file.")
+
+        selected_commands = parse_command_ids(args.command_ids, commands)
+ 
+        if not selected_commands:
+            raise LLMRunError("No valid commands selected for execution.")
+
+        if args.dry_run:
+            for command in selected_commands:
+                print(f"Command '{command['id']}' ({command.get('type')})")
+            return
 
         # Process directives
         target_directory = Path(data.get("target", {}).get("directory", "output")).resolve()
+        # Create the target directory if it does not exist, a single mkdir call rather than an exists() probe first
+        target_directory.mkdir(parents=True, exist_ok=True)
 
         # Initialize MacroResolver
         shared_prompts = data.get("shared_prompts", {})
         macro_resolver = MacroResolver(shared_prompts)
 
         # Initialize ContextManager
-        context_manager = ContextManager(target_directory)
+        context_manager = ContextManager(
+            target_directory,
+            exclude_dirs=defaults.get("filelist_exclude_dirs"),
+            max_filelist_entries=defaults.get("filelist_max_entries"))
 
-        # Initialize LLM End Point
-        llm_end_point = LLMEndPointCached(cache_dir=Path(f"{output_dir}/cache"))
+        # LLM calls are network bound, the worker threads spend almost all of their time waiting on the API,
+        # so this is limited by the provider's rate limits rather than the local machine.
+        max_workers = args.max_workers or defaults.get("max_workers", 3)
 
-        # Parse command_ids and map to commands
-        commands = data.get("commands", [])
-        if not commands:
-            raise LLMRunError("No commands found in the instruction file.")
+        # Initialize LLM End Point
+        cache_dir = args.cache_dir or Path(f"{output_dir}/cache")
+        rate_limiter = RateLimiter(rpm=defaults.get("rpm"), tpm=defaults.get("tpm"))
+        llm_end_point = LLMEndPointCached(cache_dir=cache_dir, ttl=args.cache_ttl, read_cache=not args.no_cache, rate_limiter=rate_limiter)
 
-        selected_commands = parse_command_ids(args.command_ids, commands)
- 
-        if not selected_commands:
-            raise LLMRunError("No valid commands selected for execution.")
-        
         # Initialize and execute selected commands
         for command in selected_commands:
             command_executor = CommandExecutor.create_executor(
@@ -166,7 +187,7 @@ def main():
                 llm_end_point=llm_end_point,
                 macro_resolver=macro_resolver,
                 context_manager=context_manager,
-                max_workers=3  # Adjust based on your system and OpenAI rate limits
+                max_workers=max_workers
             )
             command_executor.execute()
 
@@ -177,6 +198,12 @@ def main():
         logging.error(f"An unexpected error occurred: {e}\n{traceback.format_exc()}")
         print(f"An unexpected error occurred: {e}")
         sys.exit(1)
+    finally:
+        if llm_end_point is not None:
+            llm_end_point.close()
+        # Flush the queued command and prompt logs to disk.
+        if logger_manager is not None:
+            logger_manager.close()
 
 
 if __name__ == "__main__":
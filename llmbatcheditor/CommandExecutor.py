@@ -1,25 +1,50 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Iterator, Optional
 import os
 from pathlib import Path
 import logging
 import subprocess
 import re
+import signal
+import stat
 import traceback
+import uuid
 import concurrent.futures
+import itertools
 import threading
 
 from llmbatcheditor.LLMRunError import LLMRunError
+from llmbatcheditor.LLMFatalError import LLMFatalError
 from llmbatcheditor.LLMEndPoint import LLMEndPoint
 from llmbatcheditor.InstructionParser import InstructionParser
 from llmbatcheditor.LoggerManager import LoggerManager
 from llmbatcheditor.ContextManager import ContextManager
 from llmbatcheditor.MacroResolver import MacroResolver
 
+# Fenced code block in an LLM response, group 1 is the code.
+_CODE_BLOCK_RE = re.compile(r"```[a-zA-Z0-9\+]*\n(.*?)```", re.DOTALL)
+
+# Per-file section header in batched prompts and responses, group 1 is the file name.
+# Tolerates the markdown emphasis models sometimes wrap around the header line.
+_FILE_HEADER_RE = re.compile(r"^[#*` \t]*=== FILE: (.+?) ===[*` \t]*$", re.MULTILINE)
+
+# Fence wrapped around a whole batch section, group 1 is the content. The closing fence must end the section,
+# so fenced blocks inside a markdown file are kept.
+_SECTION_FENCE_RE = re.compile(r"\A(`{3,})[\w+-]*[ \t]*\n(.*?)\n?\1[ \t]*\Z", re.DOTALL)
+
+# Signal numbers, a shell reports a command killed by signal N as return code 128 + N.
+_SIGNAL_NUMBERS = frozenset(sig.value for sig in signal.Signals)
+
 class CommandExecutor:
     """
     Base class for executing commands. Provides common functionality for different types of command executors.
     """
     _preedit_lock = threading.Lock()
+
+    # Model used when neither the command nor the defaults set one.
+    fallback_model = "gpt-4"
+
+    # Shared pool for blocking file reads, lets a worker read its target file and its context files at the same time.
+    _io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="llmbatchedit-io")
     
     @staticmethod
     def create_executor(command: Dict[str, Any], instruction_data: Dict[str, Any], instruction_dir: Path, target_dir: Path,
@@ -40,6 +65,8 @@ class CommandExecutor:
                  context_manager: ContextManager, max_workers: int = 5):
         self.command = command
         self.defaults = instruction_data.get("defaults", {})
+        self.default_model = self.defaults.get("model", self.fallback_model)
+        self.default_prompt_model = self.defaults.get("prompt_model", "gpt-4o")
         self.shared_prompts = instruction_data.get("shared_prompts", {})
         self.instruction_dir = instruction_dir
         self.target_dir = target_dir
@@ -47,20 +74,245 @@ class CommandExecutor:
         self.llm_end_point = llm_end_point
         self.macro_resolver = macro_resolver
         self.context_manager = context_manager
-        self.max_workers = max_workers  # Maximum number of threads for parallel processing
+        # Maximum number of threads for parallel processing, a command can raise or lower the run-wide value.
+        self.max_workers = command.get("max_workers", max_workers)
+        # Pre-edited instructions keyed on (instruction, prompt_model), see prepare_instruction.
+        self._prepared_instructions: Dict[Tuple[str, str], str] = {}
+        self._prepared_lock = threading.Lock()
 
-    def extract_content_to_write(self, file_name: str, llm_response: str) -> str:
+    def iter_completed(self, future_to_item: Dict[concurrent.futures.Future, Any]) -> Iterator[Tuple[Any, Optional[BaseException]]]:
+        """
+        Yields (item, exception) for each future as it finishes, exception is None on success.
+        An LLMFatalError cancels the futures that have not started yet and is raised right away.
+        """
+        pending = set(future_to_item)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_EXCEPTION)
+            for future in done:
+                error = future.exception()
+                if isinstance(error, LLMFatalError):
+                    for not_started in pending:
+                        not_started.cancel()
+                    raise error
+                yield future_to_item[future], error
+
+    @staticmethod
+    def read_file(target_file_path: Path) -> str:
+        """
+        Reads a UTF-8 text file with one fstat and a single os.read of its size, skipping the buffered text io stack.
+        Line endings are normalized to '\n' like Path.read_text does.
+        """
+        fd = os.open(target_file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            size = os.fstat(fd).st_size
+            # Asking for one byte more than the size tells whether the file grew since the fstat.
+            data = os.read(fd, size + 1)
+            if len(data) > size:
+                chunks = [data]
+                while chunks[-1]:
+                    chunks.append(os.read(fd, 1 << 16))
+                data = b"".join(chunks)
+        finally:
+            os.close(fd)
+        text = data.decode('utf-8')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return text
+
+    def write_file(self, target_file_path: Path, content: str):
+        """
+        Replaces target_file_path with content atomically: the content goes to a temporary file next to it,
+        which is then renamed over the target. A failed write leaves the original file untouched.
+        """
+        tmp_path = target_file_path.with_name(f".{target_file_path.name}.tmp")
+        try:
+            tmp_path.write_text(content, encoding='utf-8')
+            # Keep the permissions of the file being replaced, one stat instead of exists() plus copymode's own.
+            try:
+                os.chmod(tmp_path, stat.S_IMODE(os.stat(target_file_path).st_mode))
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, target_file_path)
+            self.context_manager.invalidate_filelist()
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    def extract_content_to_write(self, file_name: str, llm_response: str) -> Optional[str]:
         content_to_write = None
         if file_name.endswith('.md'):
             # If the file is a markdown file, assume the LLM response is the file content
             content_to_write = llm_response.strip()
         else:
-            # For other file types, use regex to extract the longest code block
-            code_blocks = re.findall(r"```[a-zA-Z0-9\+]*\n(.*?)```", llm_response, re.DOTALL)
-            if code_blocks:
-                content_to_write = max(code_blocks, key=len).strip()
+            # For other file types, extract the longest code block, tracking the longest match in a single pass
+            # Only the span of the longest block is kept, the response is sliced once at the end.
+            best_span = None
+            best_len = -1
+            for match in _CODE_BLOCK_RE.finditer(llm_response):
+                start, end = match.span(1)
+                if end - start > best_len:
+                    best_len = end - start
+                    best_span = (start, end)
+            if best_span is not None:
+                content_to_write = llm_response[best_span[0]:best_span[1]].strip()
         return content_to_write
 
+    def extract_batch_content(self, file_name: str, section: str) -> Optional[str]:
+        """
+        Returns the content to write from a file's section of a batch response. The batch prompt asks for every file in
+        a fenced code block, so markdown files drop that fence too, and use the raw section only when it isn't fenced.
+        """
+        if file_name.endswith('.md'):
+            match = _SECTION_FENCE_RE.match(section.strip())
+            if match is not None:
+                return match.group(2).strip()
+        return self.extract_content_to_write(file_name, section)
+
+    def build_user_message(self, shared_items: List[str], file_items: List[str]) -> Dict[str, Any]:
+        """
+        Builds the user message from the context shared by all files of the command followed by the per-file items.
+        Keeping the shared context first makes it a stable prompt prefix that the LLM providers can cache.
+        """
+        blocks = []
+        if shared_items:
+            # Joining with a trailing empty item ends the text with a newline without copying the whole joined string again.
+            blocks.append({"type": "text", "text": "\n".join(itertools.chain(shared_items, ("",)))})
+        blocks.append({"type": "text", "text": "\n".join(file_items)})
+        return {"role": "user", "content": blocks}
+
+    def split_batch_response(self, llm_response: str) -> Dict[str, str]:
+        """
+        Splits a batched LLM response into the text following each '=== FILE: <name> ===' header, keyed on file name.
+        """
+        sections = {}
+        headers = list(_FILE_HEADER_RE.finditer(llm_response))
+        for index, header in enumerate(headers):
+            end = headers[index + 1].start() if index + 1 < len(headers) else len(llm_response)
+            sections[header.group(1).strip()] = llm_response[header.end():end]
+        return sections
+
+    def process_batch(self,
+            file_names: List[str],
+            instruction: str,
+            context_patterns: List[str],
+            model: str,
+            prompt_model: str,
+            include_content: bool,
+            filelist: str,
+            logger: logging.Logger):
+        """
+        Creates or edits several target files with a single LLM request, amortizing the round trip and the shared context.
+        Each file gets its own '=== FILE: <name> ===' section in the prompt, with its current content when include_content
+        is set, and the response is split on the same headers.
+        Returns the files written, targets that couldn't be read are logged and left out of the request.
+        Raises LLMRunError naming the files the response did not contain, after writing the ones it did.
+        """
+        logger.info(f"Processing batch {file_names}.")
+
+        # expand shared prompts, then edit the instruction with the prompt model, once per command
+        llm_edited_instruction = self.prepare_instruction(instruction, prompt_model)
+
+        file_items = []
+        # Files that made it into the prompt, a target that can't be read is left out like a single-file edit skips it.
+        batch_files = []
+        for file_name in file_names:
+            if include_content:
+                try:
+                    file_content = self.read_file(self.target_dir / file_name)
+                except (OSError, UnicodeError) as e:
+                    logger.error(f"Failed to read file '{file_name}': {e}")
+                    continue
+            placeholders = {
+                "filename": file_name,
+                "filename_base": os.path.splitext(file_name)[0],
+                "filelist": filelist
+            }
+            file_items.append(f"=== FILE: {file_name} ===")
+            if include_content:
+                file_items.append(file_content)
+                file_items.append('-'*80)
+            file_items.append(self.macro_resolver.resolve_placeholders(llm_edited_instruction, placeholders))
+            file_items.append("")
+            batch_files.append(file_name)
+
+        if not batch_files:
+            return []
+        file_names = batch_files
+
+        file_items.append('-'*80)
+        file_items.append("Reply with one section for each of the files above, in the same order. "
+                          "Start each section with the line '=== FILE: <file name> ===' on its own, "
+                          "followed by the complete content of that file in a single fenced code block.")
+
+        context_items = self.context_manager.gather_context(context_patterns, filelist)
+        user_message = self.build_user_message(context_items, file_items)
+        prompt_text = LLMEndPoint.message_text(user_message)
+
+        llm_response = self.llm_end_point.get_response([user_message], model=model)
+        sections = self.split_batch_response(llm_response)
+
+        missing = []
+        for file_name in file_names:
+            # Every file of the batch logs the full prompt, and its own section of the response.
+            file_loggers = self.logger_manager.setup_file_loggers(logger.name, file_name)
+            file_loggers["prompt"].info(prompt_text)
+            section = sections.get(file_name)
+            file_loggers["output"].info(section if section is not None else llm_response)
+
+            content_to_write = self.extract_batch_content(file_name, section) if section is not None else None
+            if content_to_write is None:
+                missing.append(file_name)
+                continue
+
+            self.write_file(self.target_dir / file_name, content_to_write)
+
+        if missing:
+            raise LLMRunError(f"The LLM response did not contain a section for {missing}.")
+        return file_names
+
+    def execute_batches(self,
+            target_files: List[str],
+            batch_size: int,
+            instruction: str,
+            context_patterns: List[str],
+            model: str,
+            prompt_model: str,
+            include_content: bool,
+            action: str,
+            filelist: str,
+            logger: logging.Logger):
+        """
+        Runs process_batch over target_files in groups of batch_size, the groups are processed in parallel.
+        """
+        batches = [target_files[i:i + batch_size] for i in range(0, len(target_files), batch_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            future_to_batch = {
+                executor.submit(self.process_batch, batch, instruction, context_patterns, model, prompt_model, include_content, filelist, logger): batch
+                for batch in batches
+            }
+            # Each future is kept with its batch, for the files process_batch actually wrote.
+            future_to_item = {future: (batch, future) for future, batch in future_to_batch.items()}
+            for (batch, future), error in self.iter_completed(future_to_item):
+                if error is None:
+                    written = future.result()
+                    if written:
+                        logger.info(f"Files {written} {action} successfully.")
+                else:
+                    logger.error(f"Error processing batch {batch}: {error}")
+
+    def prepare_instruction(self, instruction: str, prompt_model: str) -> str:
+        """
+        Expands the shared prompts in instruction and pre-edits it with prompt_model.
+        The instruction is the same for every target file of a command, so the result is kept for the other files.
+        """
+        key = (instruction, prompt_model)
+        with self._prepared_lock:
+            prepared = self._prepared_instructions.get(key)
+            if prepared is None:
+                prepared = self.preedit_instruction(self.macro_resolver.resolve_shared_prompts(instruction), model=prompt_model)
+                self._prepared_instructions[key] = prepared
+        return prepared
+
     def preedit_instruction(self, instruction: str, model: str) -> str:
         """Pre-edits the given instruction to format it as a Markdown list.
         This method takes an instruction string and a model identifier, formats the instruction
@@ -100,6 +352,8 @@ class LLMCreateExecutor(CommandExecutor):
     """
     Executor for handling 'llm_create' commands. Creates new files based on LLM responses.
     """
+    fallback_model = "gpt-4o"
+
     def __init__(self, command: Dict[str, Any], instruction_data: Dict[str, Any], instruction_dir: Path, target_dir: Path,
                  logger_manager: LoggerManager, llm_end_point: LLMEndPoint, macro_resolver: MacroResolver,
                  context_manager: ContextManager, max_workers: int = 5):
@@ -122,22 +376,28 @@ class LLMCreateExecutor(CommandExecutor):
         target_files = command.get("target_files", [])
         instruction = command.get("instruction", "")
         context_patterns = command.get("context", [])
-        model = command.get("model", self.defaults.get("model", "gpt-4o"))
-        prompt_model = command.get("prompt_model", self.defaults.get("prompt_model", "gpt-4o"))
+        model = command.get("model", self.default_model)
+        prompt_model = command.get("prompt_model", self.default_prompt_model)
+        batch_size = command.get("batch_size", 1)
+
+        # The file list is the same for every target file, walk the target directory once per command.
+        filelist = self.context_manager.generate_filelist()
+
+        if batch_size > 1:
+            self.execute_batches(target_files, batch_size, instruction, context_patterns, model, prompt_model, False, "created", filelist, logger)
+            return
 
         # Use ThreadPoolExecutor for parallel processing
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             future_to_file = {
-                executor.submit(self.process_create_file, file_name, instruction, context_patterns, model, prompt_model, logger): file_name
+                executor.submit(self.process_create_file, file_name, instruction, context_patterns, model, prompt_model, filelist, logger): file_name
                 for file_name in target_files
             }
-            for future in concurrent.futures.as_completed(future_to_file):
-                file_name = future_to_file[future]
-                try:
-                    future.result()
+            for file_name, error in self.iter_completed(future_to_file):
+                if error is None:
                     logger.info(f"File '{file_name}' created successfully.")
-                except Exception as e:
-                    logger.error(f"Error creating file '{file_name}': {e}")
+                else:
+                    logger.error(f"Error creating file '{file_name}': {error}")
 
     def process_create_file(self, 
             file_name: str, 
@@ -145,45 +405,45 @@ class LLMCreateExecutor(CommandExecutor):
             context_patterns: List[str], 
             model: str, 
             prompt_model: str, 
+            filelist: str,
             logger: logging.Logger):
         logger.info(f"Creating file '{file_name}'.")
         
-        # expand shared prompts, then edit the instruction with the prompt model 
-        llm_edited_instruction = self.preedit_instruction(
-            self.macro_resolver.resolve_shared_prompts(instruction), 
-            model=prompt_model)
+        # expand shared prompts, then edit the instruction with the prompt model, once per command
+        llm_edited_instruction = self.prepare_instruction(instruction, prompt_model)
 
         # Resolve placeholders in the edited intructions
         placeholders = {
             "filename": file_name,
             "filename_base": os.path.splitext(file_name)[0],
-            "filelist": self.context_manager.generate_filelist()
+            "filelist": filelist
         }        
         resolved_instruction = self.macro_resolver.resolve_placeholders(llm_edited_instruction, placeholders)
 
         # Gather file context 
-        context_items = self.context_manager.gather_context(context_patterns)
+        context_items = self.context_manager.gather_context(context_patterns, filelist)
 
-        # Combine context into a single string or structure as needed
-        full_prompt = resolved_instruction + "\n" + "\n".join(context_items)
+        # Shared context first, the file specific instruction last
+        user_message = self.build_user_message(context_items, [resolved_instruction])
 
         # Log prompt
         file_loggers = self.logger_manager.setup_file_loggers(logger.name, file_name)
-        file_loggers["prompt"].info(full_prompt)
+        file_loggers["prompt"].info(LLMEndPoint.message_text(user_message))
 
         # Get LLM response
-        llm_response = self.llm_end_point.get_response([{"role": "user", "content": full_prompt}], model=model)
+        llm_response = self.llm_end_point.get_response([user_message], model=model)
 
         # Log response
         file_loggers["output"].info(llm_response)
 
         # Process LLM output
         content_to_write = self.extract_content_to_write(file_name, llm_response)
- 
+        if content_to_write is None:
+            raise LLMRunError(f"No code block found in the LLM response for '{file_name}', the file was not written.")
+
         # Write to target file
         target_file_path = self.target_dir / file_name
-        with open(target_file_path, 'w', encoding='utf-8') as f:
-            f.write(content_to_write)
+        self.write_file(target_file_path, content_to_write)
 
 class LLMEditExecutor(CommandExecutor):
     """
@@ -211,22 +471,34 @@ class LLMEditExecutor(CommandExecutor):
         target_files = command.get("target_files", [])
         instruction = command.get("instruction", "")
         context_patterns = command.get("context", [])
-        model = command.get("model", self.defaults.get("model", "gpt-4"))
-        prompt_model = command.get("prompt_model", self.defaults.get("prompt_model", "gpt-4o"))
+        model = command.get("model", self.default_model)
+        prompt_model = command.get("prompt_model", self.default_prompt_model)
+        batch_size = command.get("batch_size", 1)
+
+        # The file list is the same for every target file, walk the target directory once per command.
+        filelist = self.context_manager.generate_filelist()
+
+        if batch_size > 1:
+            existing_files = []
+            for file_name in target_files:
+                if (self.target_dir / file_name).exists():
+                    existing_files.append(file_name)
+                else:
+                    logger.error(f"File '{file_name}' does not exist. Skipping.")
+            self.execute_batches(existing_files, batch_size, instruction, context_patterns, model, prompt_model, True, "edited", filelist, logger)
+            return
 
         # Use ThreadPoolExecutor for parallel processing
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             future_to_file = {
-                executor.submit(self.process_edit_file, file_name, instruction, context_patterns, model, prompt_model, logger): file_name
+                executor.submit(self.process_edit_file, file_name, instruction, context_patterns, model, prompt_model, filelist, logger): file_name
                 for file_name in target_files
             }
-            for future in concurrent.futures.as_completed(future_to_file):
-                file_name = future_to_file[future]
-                try:
-                    future.result()
+            for file_name, error in self.iter_completed(future_to_file):
+                if error is None:
                     logger.info(f"File '{file_name}' edited successfully.")
-                except Exception as e:
-                    logger.error(f"Error editing file '{file_name}': {e}")
+                else:
+                    logger.error(f"Error editing file '{file_name}': {error}")
 
     def process_edit_file(self, 
             file_name: str, 
@@ -234,6 +506,7 @@ class LLMEditExecutor(CommandExecutor):
             context_patterns: List[str], 
             model: str, 
             prompt_model: str, 
+            filelist: str,
             logger: logging.Logger):
         logger.info(f"Editing file '{file_name}'.")
         target_file_path = self.target_dir / file_name
@@ -241,53 +514,55 @@ class LLMEditExecutor(CommandExecutor):
             logger.error(f"File '{file_name}' does not exist. Skipping.")
             return
 
+        # Read the target file and the context files concurrently, the reads also overlap the instruction pre-edit below.
+        read_future = self._io_pool.submit(self.read_file, target_file_path)
+        context_future = self._io_pool.submit(self.context_manager.gather_context, context_patterns, filelist)
+
         try:
-            with open(target_file_path, 'r', encoding='utf-8') as f:
-                
-                target_file_content = f.read()
-        except Exception as e:
+            target_file_content = read_future.result()
+        except (OSError, UnicodeError) as e:
             logger.error(f"Failed to read file '{file_name}': {e}")
             return
 
-        # expand shared prompts, then edit the instruction with the prompt model 
-        llm_edited_instruction = self.preedit_instruction(
-            self.macro_resolver.resolve_shared_prompts(instruction), 
-            model=prompt_model)
+        # expand shared prompts, then edit the instruction with the prompt model, once per command
+        llm_edited_instruction = self.prepare_instruction(instruction, prompt_model)
 
         # Resolve placeholders in the edited intructions
         placeholders = {
             "filename": file_name,
             "filename_base": os.path.splitext(file_name)[0],
-            "filelist": self.context_manager.generate_filelist()
+            "filelist": filelist
         }
         resolved_instruction = self.macro_resolver.resolve_placeholders(llm_edited_instruction, placeholders)
 
-        # Gather context, including the current file content
-        context_items = []
+        # Gather context, the shared context goes first, then the current file content and the instruction
+        context_items = context_future.result()
 
-        context_items.append('-'*80) 
-        context_items.append(f"File: {file_name}")
-        context_items.append('-'*80) 
-        context_items.append(target_file_content)
-        context_items.extend( self.context_manager.gather_context(context_patterns))
+        file_items = []
+        file_items.append('-'*80) 
+        file_items.append(f"File: {file_name}")
+        file_items.append('-'*80) 
+        file_items.append(target_file_content)
+        file_items.append(resolved_instruction)
 
-        full_prompt = resolved_instruction + "\n" + "\n".join(context_items)
+        user_message = self.build_user_message(context_items, file_items)
 
         # Log prompt
         file_loggers = self.logger_manager.setup_file_loggers(logger.name, file_name)
-        file_loggers["prompt"].info(full_prompt)
+        file_loggers["prompt"].info(LLMEndPoint.message_text(user_message))
 
         # Get LLM response
-        llm_response = self.llm_end_point.get_response([{"role": "user", "content": full_prompt}], model=model)
+        llm_response = self.llm_end_point.get_response([user_message], model=model)
 
         # Log response
         file_loggers["output"].info(llm_response)
 
         content_to_write = self.extract_content_to_write(file_name, llm_response)
- 
+        if content_to_write is None:
+            raise LLMRunError(f"No code block found in the LLM response for '{file_name}', the file was left unchanged.")
+
         # Write updated content to the file
-        with open(target_file_path, 'w', encoding='utf-8') as f:
-            f.write(content_to_write)
+        self.write_file(target_file_path, content_to_write)
 
 class LLMFeedbackEditExecutor(CommandExecutor):
     """
@@ -318,20 +593,97 @@ class LLMFeedbackEditExecutor(CommandExecutor):
         test_commands = command.get("test_commands", [])
         max_retries = command.get("max_retries", 3)
         context_patterns = command.get("context", [])
-        model = command.get("model", self.defaults.get("model", "gpt-4"))
-        prompt_model = command.get("prompt_model", self.defaults.get("prompt_model", "gpt-4o"))
+        model = command.get("model", self.default_model)
+        prompt_model = command.get("prompt_model", self.default_prompt_model)
+        parallel_tests = command.get("parallel_tests", False)
+
+        # The file list is the same for every target file and retry, walk the target directory once per command.
+        filelist = self.context_manager.generate_filelist()
 
         # Use ThreadPoolExecutor for parallel processing
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             future_to_file = {
-                executor.submit(self.process_feedback_edit_file, file_name, instruction, test_commands, max_retries, context_patterns, model, prompt_model, logger): file_name
+                executor.submit(self.process_feedback_edit_file, file_name, instruction, test_commands, max_retries, context_patterns, model, prompt_model, filelist, parallel_tests, logger): file_name
                 for file_name in target_files
             }
-            for future in concurrent.futures.as_completed(future_to_file):
-                file_name = future_to_file[future]
-                future.result()
+            for file_name, error in self.iter_completed(future_to_file):
+                if error is not None:
+                    raise error
                 logger.info(f"Feedback-editing completed successfully for '{file_name}'.")
 
+    def run_test_command(self, cmd_resolved: str) -> subprocess.CompletedProcess:
+        """
+        Runs one test command through the shell in the target directory.
+        """
+        return subprocess.run(cmd_resolved, shell=True, capture_output=True, text=True, cwd=self.target_dir)
+
+    def run_test_commands_in_one_shell(self, resolved_commands: List[str]) -> List[subprocess.CompletedProcess]:
+        """
+        Runs several test commands one after the other in a single /bin/sh, instead of starting a shell per command.
+        The commands are passed to the shell as arguments and each is eval'd in its own subshell, so the command text
+        means the same as in a separate run and an 'exit' or 'cd' doesn't affect the next one. Every command is followed
+        by a marker line on stdout carrying its return code and one on stderr, which split the output back per command.
+        A return code above 128 is reported as the negative signal number, as subprocess does for a killed process.
+        Returns the results of the commands that completed, fewer than given when a command killed the shell,
+        so the caller only runs the remaining ones separately.
+        """
+        marker = f"__llmbatchedit_{uuid.uuid4().hex}__"
+        # The subshell clears the positional parameters and the script's variables are namespaced, so a command sees
+        # the same $@ and variables as in a separate run.
+        script = ('__llmbatchedit_marker=$1; shift; '
+                  'for __llmbatchedit_cmd do (set --; eval "$__llmbatchedit_cmd"); '
+                  'printf \'\\n%s %d\\n\' "$__llmbatchedit_marker" $?; printf \'\\n%s\\n\' "$__llmbatchedit_marker" >&2; done')
+        result = subprocess.run(["/bin/sh", "-c", script, "sh", marker, *resolved_commands],
+                                capture_output=True, text=True, cwd=self.target_dir)
+
+        # stdout: out_0, '<rc_0>\n' + out_1, ..., '<rc_n-1>\n'    stderr: err_0, ..., err_n-1, ''
+        stdout_parts = result.stdout.split(f"\n{marker} ")
+        stderr_parts = result.stderr.split(f"\n{marker}\n")
+        completed = min(len(stdout_parts), len(stderr_parts), len(resolved_commands) + 1) - 1
+
+        results = []
+        for i in range(completed):
+            return_code, _, next_stdout = stdout_parts[i + 1].partition("\n")
+            if not return_code.isdigit():
+                break
+            return_code = int(return_code)
+            if return_code > 128 and return_code - 128 in _SIGNAL_NUMBERS:
+                return_code = 128 - return_code
+            results.append(subprocess.CompletedProcess(resolved_commands[i], return_code, stdout_parts[i], stderr_parts[i]))
+            stdout_parts[i + 1] = next_stdout
+        return results
+
+    def run_test_commands(self, file_name: str, test_commands: List[str], parallel_tests: bool, logger: logging.Logger) -> Tuple[str, bool]:
+        """
+        Runs the test commands for file_name, at the same time when parallel_tests is set.
+        Returns the combined output, always in test_commands order, and whether every command succeeded.
+        """
+        resolved_commands = [cmd.replace("{{filename}}", str(file_name)) for cmd in test_commands]
+        for cmd_resolved in resolved_commands:
+            logger.info(f"Running test command: {cmd_resolved}")
+
+        results = None
+        if parallel_tests and len(resolved_commands) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(resolved_commands)) as executor:
+                results = list(executor.map(self.run_test_command, resolved_commands))
+        elif os.name == "posix" and len(resolved_commands) > 1:
+            results = self.run_test_commands_in_one_shell(resolved_commands)
+            # A command killed the shell, run the ones that didn't complete separately.
+            results.extend(self.run_test_command(cmd_resolved) for cmd_resolved in resolved_commands[len(results):])
+        if results is None:
+            results = [self.run_test_command(cmd_resolved) for cmd_resolved in resolved_commands]
+
+        # The tests may have created or changed files in the target directory.
+        self.context_manager.invalidate_filelist()
+
+        combined_output = ""
+        all_success = True
+        for cmd_resolved, result in zip(resolved_commands, results):
+            combined_output += f"$ {cmd_resolved}\nReturn Code: {result.returncode}\nStdout:\n{result.stdout}\nStderr:\n{result.stderr}\n"
+            if result.returncode != 0:
+                all_success = False
+        return combined_output, all_success
+
     def process_feedback_edit_file(
             self, 
             file_name: str, 
@@ -341,6 +693,8 @@ class LLMFeedbackEditExecutor(CommandExecutor):
             context_patterns: List[str], 
             model: str, 
             prompt_model: str,
+            filelist: str,
+            parallel_tests: bool,
             logger: logging.Logger):
         logger.info(f"Feedback-editing file '{file_name}'.")
         target_file_path = self.target_dir / file_name
@@ -356,75 +710,93 @@ class LLMFeedbackEditExecutor(CommandExecutor):
         
         context_files = []
         prompt = []
-        
-        while retry_count < max_retries and not success:
+
+        # One pair of log files for the file, each retry is prefixed with its number.
+        file_loggers = self.logger_manager.setup_file_loggers(logger.name, file_name)
+
+        # The instruction is the same for every retry, resolve it once.
+        placeholders = {
+            "filename": file_name,
+            "filename_base": os.path.splitext(file_name)[0],
+            "filelist": filelist
+        }
+        resolved_instruction = None
+
+        # Content last written to the file and the (modified time, size) it was written with, so the next retry
+        # doesn't read it back unless the test commands changed it.
+        written_content = None
+        written_stat = None
+
+        # Set when the last attempt left the file as it was, the tests would only repeat their last output.
+        file_unchanged = False
+
+        # Run the tests, stop as soon as they pass, otherwise ask the LLM for a fix, at most max_retries times.
+        while True:
             try:
                 # Run test commands
-                combined_output = ""
-
-                all_success = True
-                for cmd in test_commands:
-                    cmd_resolved = cmd.replace("{{filename}}", str(file_name))
-                    logger.info(f"Running test command: {cmd_resolved}")
-                    result = subprocess.run(cmd_resolved, shell=True, capture_output=True, text=True,cwd=self.target_dir)
-                    combined_output += f"$ {cmd_resolved}\nReturn Code: {result.returncode}\nStdout:\n{result.stdout}\nStderr:\n{result.stderr}\n"
-                    if result.returncode != 0:
-                        all_success = False
+                if not file_unchanged:
+                    combined_output, all_success = self.run_test_commands(file_name, test_commands, parallel_tests, logger)
 
                 if all_success:
                     logger.info(f"Test commands succeeded for '{file_name}'.")
+                    success = True
+                    break
+
+                if retry_count >= max_retries:
+                    break
 
                 retry_count += 1
 
-                # expand shared prompts, then edit the instruction with the prompt model 
-                llm_edited_instruction = self.preedit_instruction(
-                    self.macro_resolver.resolve_shared_prompts(instruction), 
-                    model=prompt_model)
+                if resolved_instruction is None:
+                    # expand shared prompts, then edit the instruction with the prompt model, once per command
+                    llm_edited_instruction = self.prepare_instruction(instruction, prompt_model)
 
-                # Resolve placeholders in the edited intructions
-                placeholders = {
-                    "filename": file_name,
-                    "filename_base": os.path.splitext(file_name)[0],
-                    "filelist": self.context_manager.generate_filelist()
-                }
-                resolved_instruction = self.macro_resolver.resolve_placeholders(llm_edited_instruction, placeholders)
+                    # Resolve placeholders in the edited intructions
+                    resolved_instruction = self.macro_resolver.resolve_placeholders(llm_edited_instruction, placeholders)
 
-                context_items = []
+                file_items = []
 
                 # command(s) output
-                context_items.append('-'*80) 
-                context_items.append(f"Output:")
-                context_items.append('-'*80) 
-                context_items.append(combined_output)
+                file_items.append('-'*80) 
+                file_items.append(f"Output:")
+                file_items.append('-'*80) 
+                file_items.append(combined_output)
 
                 # the file being edited.
-                context_items.append('-'*80) 
-                context_items.append(f"File: {file_name} Revision: {retry_count}")
-                context_items.append('-'*80) 
+                file_items.append('-'*80) 
+                file_items.append(f"File: {file_name} Revision: {retry_count}")
+                file_items.append('-'*80) 
 
-                # Gather context, including the current file content
+                # Gather context, including the current file content. The file and the context files are read concurrently.
+                context_future = self._io_pool.submit(self.context_manager.load_file_data, context_patterns)
                 try:
-                    with open(target_file_path, 'r', encoding='utf-8') as f:
-                        current_content = f.read()
-                except Exception as e:
+                    file_stat = target_file_path.stat()
+                    if written_content is not None and (file_stat.st_mtime_ns, file_stat.st_size) == written_stat:
+                        current_content = written_content
+                    else:
+                        current_content = self.read_file(target_file_path)
+                except (OSError, UnicodeError) as e:
                     logger.error(f"Failed to read file '{file_name}' during feedback-edit: {e}")
                     break
 
-                context_items.append(current_content)
+                file_items.append(current_content)
+                file_items.append(resolved_instruction)
 
-                context_files_cycle = self.context_manager.load_file_data(context_patterns)
+                context_files_cycle = context_future.result()
 
                 # Add context files to the context_items list, ensuring no duplicates.
                 # Skip the file currently being edited and any files already included in context_files.
+                # The context files go before the output and the file being edited so they extend the cached prompt prefix.
+                context_items = []
 
                 # Don't emit the edit file, and the content did not change    
                 for context_file_cyle in context_files_cycle:
                     skip = False
 
                     if context_file_cyle['filename'] == file_name:
-                        skipe = True                    
+                        skip = True                    
                     for context_file in context_files:
-                        if context_file['filename'] == context_file_cyle['filename'] and context_file['modified_time'] == context_file_cyle['modified_time']:
+                        if context_file['filename'] == context_file_cyle['filename'] and context_file.get('modified_time') == context_file_cyle.get('modified_time'):
                             skip = True
 
                     if ( not skip ):
@@ -435,27 +807,41 @@ class LLMFeedbackEditExecutor(CommandExecutor):
 
                         context_files.append(context_file_cyle)
 
-                full_prompt = resolved_instruction + "\n" + "\n".join(context_items)
+                user_message = self.build_user_message(context_items, file_items)
 
                 # Log prompt
-                file_loggers = self.logger_manager.setup_file_loggers(logger.name, file_name,retry_count)
-
-                file_loggers["prompt"].info(full_prompt)
+                # The retry header is its own record, so the prompt isn't copied again just to prefix it.
+                file_loggers["prompt"].info(f"[retry {retry_count}]")
+                file_loggers["prompt"].info(LLMEndPoint.message_text(user_message))
 
                 # Get LLM response from API.
-                prompt.append({"role": "user", "content": full_prompt})
+                prompt.append(user_message)
                 llm_response = self.llm_end_point.get_response(prompt, model=model)
 
+                file_loggers["output"].info(f"[retry {retry_count}]")
                 file_loggers["output"].info(llm_response)
 
                 content_to_write = self.extract_content_to_write(file_name, llm_response)
         
                 # Write updated content to the file
-                if ( content_to_write is not None):
-                    with open(target_file_path, 'w', encoding='utf-8') as f:
-                        f.write(content_to_write)
+                # extract_content_to_write strips the content, compare it with the file stripped the same way.
+                if content_to_write is not None and content_to_write == current_content.strip():
+                    logger.warning(f"The LLM returned '{file_name}' unchanged (attempt {retry_count}), the tests are not run again.")
+                    file_unchanged = True
+                elif ( content_to_write is not None):
+                    file_unchanged = False
+                    self.write_file(target_file_path, content_to_write)
+                    # Reading back would turn '\r\n' into '\n', only remember content that reads back unchanged.
+                    if '\r' not in content_to_write:
+                        file_stat = target_file_path.stat()
+                        written_content = content_to_write
+                        written_stat = (file_stat.st_mtime_ns, file_stat.st_size)
+                    else:
+                        written_content = None
                 else:
-                    success = True
+                    # Usually a truncated response, the next attempt asks for the fix again with the same test output.
+                    file_unchanged = True
+                    logger.warning(f"No code block found in the LLM response for '{file_name}' (attempt {retry_count}).")
             except Exception as e:
                 logger.error(f"Error during feedback-editing of '{file_name}': {e}")
                 raise 
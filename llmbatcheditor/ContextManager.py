@@ -1,7 +1,10 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Optional
 
+import binascii
 import logging
 import os
+import stat
+import threading
 import time
 
 from pathlib import Path
@@ -32,43 +35,108 @@ BINARY_EXTENSIONS = {
     # Add more as needed
 }
 
+# Directories left out of the generated file list, unless the instruction file sets defaults.filelist_exclude_dirs.
+DEFAULT_FILELIST_EXCLUDE_DIRS = frozenset({"log", "__pycache__", "node_modules", ".venv", ".git", "dist", "build"})
+
+# Entries kept in the generated file list, unless the instruction file sets defaults.filelist_max_entries.
+DEFAULT_FILELIST_MAX_ENTRIES = 2000
+
+# Context files are cut off after this many characters (bytes for binary files), so a stray large file matched
+# by a pattern can't exhaust memory or blow past the model's context window.
+MAX_CONTEXT_FILE_SIZE = 1 << 20
+
+# Byte translation table for the ASCII column of binary file dumps, non-printable bytes become '.'
+_PRINTABLE_TABLE = bytes(byte if 32 <= byte <= 126 else ord('.') for byte in range(256))
+
 class ContextManager:
     """Manages context gathering based on file patterns."""
 
-    def __init__(self, target_directory: Path):
+    def __init__(self, target_directory: Path, exclude_dirs: Optional[List[str]] = None, max_filelist_entries: Optional[int] = None):
         self.target_directory = target_directory
+        self.exclude_dirs = frozenset(exclude_dirs) if exclude_dirs is not None else DEFAULT_FILELIST_EXCLUDE_DIRS
+        self.max_filelist_entries = max_filelist_entries if max_filelist_entries is not None else DEFAULT_FILELIST_MAX_ENTRIES
+        # Loaded file data keyed on path, with the (modified time, size) it was read at. Shared by the worker threads.
+        self._file_cache: Dict[Path, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+        self._file_cache_lock = threading.Lock()
+        # Last generated file list, with the target directory's modified time when it was generated.
+        self._filelist_cache: Optional[Tuple[int, str]] = None
+
+    def invalidate_filelist(self):
+        """
+        Drops the cached file list, call it after writing or creating files in the target directory.
+        """
+        self._filelist_cache = None
 
     def generate_filelist(self) -> str:
         """
         Generates a list of files in the target directory with their sizes.
-        Excludes 'log' and '__pycache__' directories.
-        For binary files, includes a snippet of their content.
+        Excludes the exclude_dirs directories, and stops after max_filelist_entries files with a note of how many were left out.
+        The list is cached until invalidate_filelist() is called or the target directory's modified time changes.
         """
+        dir_mtime = self.target_directory.stat().st_mtime_ns
+        cached = self._filelist_cache
+        if cached is not None and cached[0] == dir_mtime:
+            return cached[1]
+
         filelist = []
-        for root, dirs, files in os.walk(self.target_directory):
-            # Exclude 'log' and '__pycache__' directories
-            dirs[:] = [d for d in dirs if d not in ("log", "__pycache__")]
-            for file in files:
-                file_path = Path(root) / file
-                rel_path = file_path.relative_to(self.target_directory)
-                size = file_path.stat().st_size
-                entry = f"{rel_path} - {size} bytes"
-                filelist.append(entry)
-        return "\n".join(filelist)
-
-    def gather_context(self, patterns: List[str]) -> List[str]:
+        self._scan_filelist(str(self.target_directory), "", filelist)
+        if len(filelist) > self.max_filelist_entries:
+            omitted = len(filelist) - self.max_filelist_entries
+            del filelist[self.max_filelist_entries:]
+            filelist.append(f"[...{omitted} more files omitted...]")
+        filelist_str = "\n".join(filelist)
+        self._filelist_cache = (dir_mtime, filelist_str)
+        return filelist_str
+
+    def _scan_filelist(self, directory: str, rel_prefix: str, filelist: List[str]):
+        """
+        Appends '<relative path> - <size> bytes' for the files in directory to filelist, then recurses into its
+        subdirectories, in the same order as os.walk. The directory entries tell files from directories without
+        an extra stat, so each file costs a single stat for its size.
+        """
+        try:
+            with os.scandir(directory) as scan:
+                entries = list(scan)
+        except OSError:
+            # Unreadable directories are skipped, as os.walk does
+            return
+
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                # Skip the excluded directories, and like os.walk don't follow directory links
+                if entry.name not in self.exclude_dirs and not entry.is_symlink():
+                    subdirs.append(entry)
+                continue
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                # A dangling link reports the size of the link itself, a file removed since the scan is left out.
+                try:
+                    size = entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+            filelist.append(f"{rel_prefix}{entry.name} - {size} bytes")
+
+        for entry in subdirs:
+            self._scan_filelist(entry.path, f"{rel_prefix}{entry.name}{os.sep}", filelist)
+
+    def gather_context(self, patterns: List[str], filelist_str: Optional[str] = None) -> List[str]:
         """
         Gathers context items based on glob patterns.
+        filelist_str is used for the {{filelist}} pattern when given, instead of generating the file list.
         """
-        file_data = self.load_file_data(patterns)
+        file_data = self.load_file_data(patterns, filelist_str)
         return self.format_context_items(file_data)
 
-    def load_file_data(self, patterns: List[str]) -> List[Dict[str, Any]]:
+    def load_file_data(self, patterns: List[str], filelist_str: Optional[str] = None) -> List[Dict[str, Any]]:
         """
         Loads file data based on glob patterns into a list of dictionaries.
         Each dictionary contains the filename and content as a string or formatted binary data.
+        A file matched by several patterns is loaded once, at the position of the first pattern that matched it.
         Args:
             patterns (List[str]): A list of glob patterns to match files in the target directory.
+            filelist_str (Optional[str]): The file list for the {{filelist}} pattern, generated when None.
         Returns:
             List[Dict[str, Any]]: A list of dictionaries, each containing:
                 - "filename" (str): The relative path of the file from the target directory.
@@ -77,42 +145,81 @@ class ContextManager:
                 - "modified_time" (int): The modified time of the file in nanoseconds.
         """
         file_data = []
+        # Files already matched by an earlier pattern, so overlapping patterns don't send a file twice
+        seen_paths = set()
         for pattern in patterns:
 
             if pattern == "{{filelist}}":
-                file_data.append({"filename": "list of file names", "content": self.generate_filelist()})
+                if filelist_str is None:
+                    filelist_str = self.generate_filelist()
+                file_data.append({"filename": "list of file names", "content": filelist_str})
                 continue
 
-            matched_files = list(self.target_directory.glob(pattern))
-            for file_path in matched_files:
-                if file_path.is_file():
-                    file_info = {"filename": os.path.relpath(file_path, self.target_directory)}
-                    file_info["modified_time"] = file_path.stat().st_mtime_ns  
-
-                    is_binary = file_path.suffix.lower() in BINARY_EXTENSIONS
-
-                    if ( not is_binary ):
-                        try:
-                            with open(file_path, 'r', encoding='utf-8') as f:
-                                file_info["content"] = f.read()
-                        except UnicodeDecodeError:
-                            is_binary = True
-
-                    if is_binary:
-                        with open(file_path, 'rb') as f:
-                            content = []
-                            while True:
-                                chunk = f.read(40)
-                                if not chunk:
-                                    break
-                                ascii_part = ''.join(chr(byte) if 32 <= byte <= 126 else '.' for byte in chunk)
-                                hex_part = ' '.join(f"{byte:02x}" for byte in chunk)
-                                content.append(f"{ascii_part:<40} {hex_part}")
-                            file_info["content"] = "\n".join(content)
-
+            for file_path in self.target_directory.glob(pattern):
+                if file_path in seen_paths:
+                    continue
+                seen_paths.add(file_path)
+                file_info = self.load_file_info(file_path)
+                if file_info is not None:
                     file_data.append(file_info)
         return file_data
 
+    def load_file_info(self, file_path: Path) -> Optional[Dict[str, Any]]:
+        """
+        Returns the file data dictionary for a single file, see load_file_data, or None when file_path is not a file.
+        The result is cached and reused until the file's modified time or size changes, so the workers of a
+        command and the retries of a feedback edit don't read unchanged context files again.
+        """
+        # One stat both filters out directories and fingerprints the file.
+        try:
+            file_stat = file_path.stat()
+        except OSError:
+            return None
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        fingerprint = (file_stat.st_mtime_ns, file_stat.st_size)
+        with self._file_cache_lock:
+            cached = self._file_cache.get(file_path)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+
+        file_info = {"filename": os.path.relpath(file_path, self.target_directory)}
+        file_info["modified_time"] = file_stat.st_mtime_ns
+
+        is_binary = file_path.suffix.lower() in BINARY_EXTENSIONS
+
+        truncated = False
+        if ( not is_binary ):
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    text = f.read(MAX_CONTEXT_FILE_SIZE + 1)
+                truncated = len(text) > MAX_CONTEXT_FILE_SIZE
+                file_info["content"] = text[:MAX_CONTEXT_FILE_SIZE]
+            except UnicodeDecodeError:
+                is_binary = True
+
+        if is_binary:
+            with open(file_path, 'rb') as f:
+                data = f.read(MAX_CONTEXT_FILE_SIZE + 1)
+            truncated = len(data) > MAX_CONTEXT_FILE_SIZE
+            data = data[:MAX_CONTEXT_FILE_SIZE]
+            # 40 bytes per line, the ASCII column padded to 40 characters followed by the hex bytes.
+            content = []
+            for start in range(0, len(data), 40):
+                chunk = data[start:start + 40]
+                ascii_part = chunk.translate(_PRINTABLE_TABLE).decode('ascii')
+                hex_part = binascii.hexlify(chunk, ' ').decode('ascii')
+                content.append(f"{ascii_part:<40} {hex_part}")
+            file_info["content"] = "\n".join(content)
+
+        if truncated:
+            logging.warning(f"Context file '{file_info['filename']}' is larger than {MAX_CONTEXT_FILE_SIZE} characters, it was truncated.")
+            file_info["content"] += "\n[...truncated...]"
+
+        with self._file_cache_lock:
+            self._file_cache[file_path] = (fingerprint, file_info)
+        return file_info
+
     def format_context_items(self, file_data: List[Dict[str, Any]]) -> List[str]:
         """
         Converts the list of file data hashes into a formatted list of context items.
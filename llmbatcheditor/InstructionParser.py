@@ -1,13 +1,22 @@
 from typing import List, Dict, Any
 
 import logging
+from functools import cached_property
 from pathlib import Path
-import toml
+
+# tomllib is in the standard library from Python 3.11, tomli is the same parser for older versions.
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
 from llmbatcheditor.LLMRunError import LLMRunError
 import llmbatcheditor.LLMEndPoint
 
 # Constants for built-in macros
-BUILT_IN_MACROS = {"filename", "output", "filelist", "filename_base"}
+BUILT_IN_MACROS = frozenset({"filename", "output", "filelist", "filename_base"})
+
+# Models a command or the defaults may select
+SUPPORTED_MODELS = frozenset(llmbatcheditor.LLMEndPoint.LLMEndPoint.get_supported_models())
 
 
 class InstructionParser:
@@ -19,12 +28,21 @@ class InstructionParser:
         self.data = self.load_toml()
         self.validate_unique_command_ids()
         self.validate_macros()
+        self.validate_defaults()
         self.validate_commands()
 
+    @cached_property
+    def defaults(self) -> Dict[str, Any]:
+        """
+        The [defaults] table of the instruction file, empty when it has none.
+        """
+        return self.data.get("defaults", {})
+
     def load_toml(self) -> Dict[str, Any]:
         try:
-            with open(self.instruction_path, 'r') as f:
-                data = toml.load(f)
+            # tomllib parses from a binary file and decodes the UTF-8 itself.
+            with open(self.instruction_path, 'rb') as f:
+                data = tomllib.load(f)
             logging.debug(f"Successfully loaded TOML file: {self.instruction_path}")
             return data
         except Exception as e:
@@ -44,15 +62,32 @@ class InstructionParser:
 
     def validate_macros(self):
         shared_prompts = self.data.get("shared_prompts", {})
-        for macro_name in shared_prompts:
-            if macro_name in BUILT_IN_MACROS:
-                raise LLMRunError(f"Macro name conflict: '{macro_name}' is a reserved built-in macro name.")
+        conflicts = shared_prompts.keys() & BUILT_IN_MACROS
+        if conflicts:
+            names = ", ".join(f"'{name}'" for name in sorted(conflicts))
+            raise LLMRunError(f"Macro name conflict: shared prompt(s) {names} use reserved built-in macro names.")
         logging.debug("All custom macros are validated and no conflicts found.")
 
+    def validate_defaults(self):
+        defaults = self.defaults
+        if "max_workers" in defaults:
+            max_workers = defaults.get("max_workers")
+            if not isinstance(max_workers, int) or isinstance(max_workers, bool) or max_workers <= 0:
+                raise LLMRunError("'max_workers' in defaults must be a positive integer.")
+        if "filelist_exclude_dirs" in defaults:
+            exclude_dirs = defaults.get("filelist_exclude_dirs")
+            if not isinstance(exclude_dirs, list) or not all(isinstance(d, str) for d in exclude_dirs):
+                raise LLMRunError("'filelist_exclude_dirs' in defaults must be an array of strings.")
+        for key in ("rpm", "tpm", "filelist_max_entries"):
+            if key in defaults:
+                value = defaults.get(key)
+                if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+                    raise LLMRunError(f"'{key}' in defaults must be a positive integer.")
+        logging.debug("Defaults are validated successfully.")
+
     def validate_commands(self):
         commands = self.data.get("commands", [])
-        defaults = self.data.get("defaults", {})
-        supported_models = llmbatcheditor.LLMEndPoint.LLMEndPoint.get_supported_models()
+        default_model = self.defaults.get("model")
         for index, cmd in enumerate(commands, start=1):
             cmd_id = cmd.get("id", f"<command at position {index}>")
             cmd_type = cmd.get("type")
@@ -81,13 +116,21 @@ class InstructionParser:
                 raise LLMRunError(f"Unsupported command type: '{cmd_type}' in command '{cmd_id}'.")
 
             # Validate model if specified
-            model = cmd.get("model", defaults.get("model"))
-            if model and model not in supported_models:
-                raise LLMRunError(f"Unsupported model '{model}' specified in command '{cmd_id}'. Supported models: {supported_models}")
+            model = cmd.get("model", default_model)
+            if model and model not in SUPPORTED_MODELS:
+                raise LLMRunError(f"Unsupported model '{model}' specified in command '{cmd_id}'. Supported models: {set(SUPPORTED_MODELS)}")
 
             # Validate other fields
             if not isinstance(cmd.get("target_files"), list) or not all(isinstance(f, str) for f in cmd.get("target_files")):
                 raise LLMRunError(f"'target_files' in command '{cmd_id}' must be an array of strings.")
+            if "batch_size" in cmd:
+                if cmd_type not in ("llm_create", "llm_edit"):
+                    raise LLMRunError(f"'batch_size' in command '{cmd_id}' is only supported by 'llm_create' and 'llm_edit' commands.")
+                if not isinstance(cmd.get("batch_size"), int) or isinstance(cmd.get("batch_size"), bool) or cmd.get("batch_size") <= 0:
+                    raise LLMRunError(f"'batch_size' in command '{cmd_id}' must be a positive integer.")
+            if "max_workers" in cmd:
+                if not isinstance(cmd.get("max_workers"), int) or isinstance(cmd.get("max_workers"), bool) or cmd.get("max_workers") <= 0:
+                    raise LLMRunError(f"'max_workers' in command '{cmd_id}' must be a positive integer.")
             if "context" in cmd:
                 if not isinstance(cmd.get("context"), list) or not all(isinstance(c, str) for c in cmd.get("context")):
                     raise LLMRunError(f"'context' in command '{cmd_id}' must be an array of strings.")
@@ -96,6 +139,8 @@ class InstructionParser:
                     raise LLMRunError(f"'test_commands' in command '{cmd_id}' must be an array of strings.")
                 if not isinstance(cmd.get("max_retries"), int) or cmd.get("max_retries") <= 0:
                     raise LLMRunError(f"'max_retries' in command '{cmd_id}' must be a positive integer.")
+                if "parallel_tests" in cmd and not isinstance(cmd.get("parallel_tests"), bool):
+                    raise LLMRunError(f"'parallel_tests' in command '{cmd_id}' must be a boolean.")
 
         logging.debug("All commands are validated successfully.")
 
@@ -1,12 +1,19 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 import logging
+import random
+import threading
 import time
 
+import httpx
+import openai
+import anthropic
 from openai import OpenAI
 from anthropic import Anthropic
 
 from llmbatcheditor.LLMRunError import LLMRunError
+from llmbatcheditor.LLMFatalError import LLMFatalError
+from llmbatcheditor.RateLimiter import RateLimiter
 
 
 class LLMEndPoint:
@@ -20,13 +27,59 @@ class LLMEndPoint:
     models_without_role_key = {"o1-mini", "o1-preview"}
     models_without_temp_key = {"o1-mini", "o1-preview"}
 
-    def __init__(self, max_retries: int = 3, retry_delay: int = 5):
+    # Transient failures worth another attempt, anything else (bad request, auth, unsupported model) fails immediately.
+    # Connection errors include timeouts, server errors include Anthropic's 529 overloaded.
+    retriable_errors = (
+        openai.APIConnectionError,
+        openai.RateLimitError,
+        openai.InternalServerError,
+        anthropic.APIConnectionError,
+        anthropic.RateLimitError,
+        anthropic.InternalServerError,
+    )
+
+    # Failures no other request can get past, they raise LLMFatalError so the whole command stops.
+    fatal_errors = (
+        openai.AuthenticationError,
+        openai.PermissionDeniedError,
+        anthropic.AuthenticationError,
+        anthropic.PermissionDeniedError,
+    )
+
+    # Upper bound in seconds on the backoff between attempts.
+    max_retry_delay = 60
+
+    def __init__(self, max_retries: int = 3, retry_delay: int = 5, rate_limiter: Optional[RateLimiter] = None):
         self.max_retries = max_retries
         self.retry_delay = retry_delay
+        self.rate_limiter = rate_limiter
 
-        # Initialize clients as None for lazy instantiation
+        # Initialize clients as None for lazy instantiation. Both clients send their requests through one shared
+        # httpx connection pool, and are shared by all worker threads; the lock stops two workers creating them twice.
         self.clientOpenAI = None
         self.clientAnthropic = None
+        self._http_client = None
+        self._client_lock = threading.Lock()
+
+    def close(self):
+        """
+        Closes the LLM clients and their connection pools.
+        """
+        with self._client_lock:
+            for client in (self.clientOpenAI, self.clientAnthropic, self._http_client):
+                if client is not None:
+                    client.close()
+            self.clientOpenAI = None
+            self.clientAnthropic = None
+            self._http_client = None
+
+    def get_http_client(self) -> httpx.Client:
+        """
+        Returns the keep-alive connection pool shared by the OpenAI and Anthropic clients, call with _client_lock held.
+        """
+        if self._http_client is None:
+            self._http_client = httpx.Client(limits=httpx.Limits(max_connections=64, max_keepalive_connections=32))
+        return self._http_client
 
     @classmethod
     def get_supported_models(cls):
@@ -40,6 +93,8 @@ class LLMEndPoint:
 
         :param prompt: A list of dictionaries containing conversation messages with required keys "role" and "content".
                        Valid values for "role" are "system", "user", or "assistant".
+                       "content" is either a string or a list of {"type": "text", "text": ...} blocks. When a user message
+                       is split into blocks, put the content shared between requests first so providers can cache it.
         :param model: The model to use for the LLM API.
         :return: The response from the LLM.
         """
@@ -53,9 +108,21 @@ class LLMEndPoint:
         if prompt[-1].get('role') == 'assistant':
             raise ValueError("The last item in the prompt cannot have the role 'assistant' before sending to the LLM.")
 
+        prompt_tokens = 0
+        if self.rate_limiter is not None:
+            prompt_tokens = RateLimiter.estimate_tokens(
+                "".join(LLMEndPoint.message_text(message) for message in prompt),
+                model if model in LLMEndPoint.openai_models else None)
+
         for attempt in range(1, self.max_retries + 1):
             try:
-                logging.debug(f"Sending prompt to LLM (Attempt {attempt}): {prompt[-1].get('content', '')[:50]}...")
+                # Every attempt is a request against the provider's limits.
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire(prompt_tokens)
+
+                # Joining the message blocks costs as much as the prompt is long, only do it when the record is emitted.
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug("Sending prompt to LLM (Attempt %d): %.50s...", attempt, LLMEndPoint.message_text(prompt[-1]))
 
                 content = ""
                 if model in LLMEndPoint.openai_models:
@@ -65,7 +132,7 @@ class LLMEndPoint:
                 else:
                     raise ValueError(f"Unsupported model: {model}")
 
-                logging.debug(f"Received response from LLM: {content[:50]}...")
+                logging.debug("Received response from LLM: %.50s...", content)
 
                 # Overwrite the last item as the assistant response
                 prompt.append({"role": "assistant", "content": content})
@@ -73,48 +140,103 @@ class LLMEndPoint:
                 return content
 
             except Exception as e:
+                if isinstance(e, LLMEndPoint.fatal_errors):
+                    raise LLMFatalError(f"LLM API call failed: {e}") from e
+                if not isinstance(e, LLMEndPoint.retriable_errors):
+                    raise LLMRunError(f"LLM API call failed: {e}") from e
                 logging.warning(f"LLM API call failed on attempt {attempt}: {e}")
                 if attempt < self.max_retries:
-                    time.sleep(self.retry_delay)
+                    time.sleep(self.get_retry_delay(attempt, e))
+                elif isinstance(e, (openai.RateLimitError, anthropic.RateLimitError)):
+                    # Still rate limited after backing off, the other workers are too.
+                    raise LLMFatalError(f"LLM API call still rate limited after {self.max_retries} attempts: {e}") from e
                 else:
-                    raise LLMRunError(f"LLM API call failed after {self.max_retries} attempts: {e}")
+                    raise LLMRunError(f"LLM API call failed after {self.max_retries} attempts: {e}") from e
+
+    def get_retry_delay(self, attempt: int, error: Exception) -> float:
+        """
+        Returns how long to wait before the next attempt. A Retry-After header from the provider wins,
+        otherwise the delay doubles each attempt from retry_delay, with jitter so parallel workers spread out.
+        """
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            try:
+                return min(float(retry_after), LLMEndPoint.max_retry_delay)
+            except (TypeError, ValueError):
+                pass
+
+        return min(LLMEndPoint.max_retry_delay, self.retry_delay * 2 ** (attempt - 1)) + random.uniform(0, 0.5)
 
-    def get_response_antropic(self, prompt: List[Dict[str, str]], model: str) -> str:
+    @staticmethod
+    def message_text(message: Dict[str, Any]) -> str:
+        """
+        Returns the text of a message whose content is either a string or a list of text blocks.
+        """
+        content = message.get("content", "")
+        if isinstance(content, str):
+            return content
+        return "".join(block["text"] for block in content)
+
+    def get_response_antropic(self, prompt: List[Dict[str, Any]], model: str) -> str:
         if self.clientAnthropic is None:
-            self.clientAnthropic = Anthropic(timeout=120.0)
-        response = self.clientAnthropic.messages.create(
+            with self._client_lock:
+                if self.clientAnthropic is None:
+                    self.clientAnthropic = Anthropic(timeout=120.0, http_client=self.get_http_client())
+
+        # Mark the end of the leading block of the last user message as a cache breakpoint. Anthropic then caches
+        # the conversation so far plus the shared context, which the next file or the next feedback cycle reuses.
+        messages = [dict(message) for message in prompt]
+        last = messages[-1]
+        if isinstance(last["content"], list) and len(last["content"]) > 1:
+            blocks = [dict(block) for block in last["content"]]
+            blocks[0]["cache_control"] = {"type": "ephemeral"}
+            last["content"] = blocks
+
+        # Stream the response, the client timeout then applies between chunks instead of to the whole generation.
+        chunks = []
+        with self.clientAnthropic.messages.stream(
             max_tokens=8000,
             model=model,
-            messages=prompt
-        )
+            messages=messages
+        ) as stream:
+            for text in stream.text_stream:
+                chunks.append(text)
 
-        content = ""
-        if hasattr(response, "content"):
-            content = "".join(
-                block.text for block in response.content if hasattr(block, "text")
-            )
-        return content
+        return "".join(chunks)
 
-    def get_response_openAI(self, prompt: List[Dict[str, str]], model: str) -> str:
+    def get_response_openAI(self, prompt: List[Dict[str, Any]], model: str) -> str:
         if self.clientOpenAI is None:
-            self.clientOpenAI = OpenAI()
+            with self._client_lock:
+                if self.clientOpenAI is None:
+                    self.clientOpenAI = OpenAI(http_client=self.get_http_client())
+
+        # OpenAI caches matching prompt prefixes automatically, so text blocks are simply joined.
+        messages = [{"role": message["role"], "content": LLMEndPoint.message_text(message)} for message in prompt]
+
         # Ensure the prompt starts with a system message if it is not already present
-        if not prompt or prompt[0].get('role') != 'system':
+        if not messages or messages[0].get('role') != 'system':
             if model not in LLMEndPoint.models_without_role_key:
-                prompt.insert(0, {"role": "system", "content": "You are expert software engineer from MIT."})
+                messages.insert(0, {"role": "system", "content": "You are expert software engineer from MIT."})
 
         if model in LLMEndPoint.models_without_temp_key:
-            completion = self.clientOpenAI.chat.completions.create(
+            stream = self.clientOpenAI.chat.completions.create(
                 model=model,
-                messages=prompt,
+                messages=messages,
+                stream=True
             )
         else:
-            completion = self.clientOpenAI.chat.completions.create(
+            stream = self.clientOpenAI.chat.completions.create(
                 model=model,
-                messages=prompt,
-                temperature=0.1
+                messages=messages,
+                temperature=0.1,
+                stream=True
             )
 
-        content = completion.choices[0].message.content
+        # Accumulate the streamed deltas, some chunks carry no choices or no content.
+        chunks = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks.append(chunk.choices[0].delta.content)
 
-        return content
+        return "".join(chunks)
@@ -1,29 +1,122 @@
+import concurrent.futures
 import os
 import hashlib
-from typing import List, Dict, Any, Tuple
+import json
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Any, Optional
 from llmbatcheditor.LLMEndPoint import LLMEndPoint
-from pprint import pformat
+from llmbatcheditor.RateLimiter import RateLimiter
+
+# orjson is optional, it only makes building the cache key faster.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 class LLMEndPointCached(LLMEndPoint):
-    def __init__(self, cache_dir: str, max_retries: int = 3, retry_delay: int = 5):
-        super().__init__(max_retries, retry_delay)
+    """
+    LLMEndPoint that caches responses in a single SQLite database, cache.sqlite, in cache_dir.
+    Point several projects at the same cache_dir to share responses between them.
+
+    :param ttl: Maximum age in seconds of a cached response, older responses are requested again. None never expires.
+    :param read_cache: When False every prompt goes to the LLM, the responses are still stored for later runs.
+    :param rate_limiter: Limits the requests sent to the LLM, cache hits don't count against it.
+    """
+    def __init__(self, cache_dir: str, max_retries: int = 3, retry_delay: int = 5, ttl: Optional[float] = None, read_cache: bool = True,
+                 rate_limiter: Optional[RateLimiter] = None):
+        super().__init__(max_retries, retry_delay, rate_limiter)
         self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.read_cache = read_cache
         os.makedirs(self.cache_dir, exist_ok=True)
 
-    def get_response(self, prompt: List[Dict[str, str]], model: str) -> Tuple[str, bool]:
-        prompt_str = model + "\n" + pformat(prompt)
-        md5_hash = hashlib.md5(prompt_str.encode('utf-8')).hexdigest()
-        prompt_file = os.path.join(self.cache_dir, f"{md5_hash}.prompt.txt")
-        response_file = os.path.join(self.cache_dir, f"{md5_hash}.response.txt")
-
-        if os.path.exists(prompt_file) and os.path.exists(response_file):
-            with open(response_file, 'r', encoding='utf-8') as f:
-                content = f.read()
-            return content
-        else:
-            content = super().get_response(prompt, model)
-            with open(prompt_file, 'w', encoding='utf-8') as f:
-                f.write(prompt_str)
-            with open(response_file, 'w', encoding='utf-8') as f:
-                f.write(content)
-            return content
+        # One connection shared by the worker threads, serialized by the lock.
+        self._db_lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.cache_dir, "cache.sqlite"), check_same_thread=False, timeout=30.0)
+        with self._db_lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, prompt TEXT, response TEXT, created REAL)")
+            self.conn.commit()
+
+        # Responses being requested right now keyed on the cache key hash, so identical prompts sent by several
+        # workers at the same time share one LLM call instead of all missing the cache.
+        self._inflight: Dict[str, concurrent.futures.Future] = {}
+        self._inflight_lock = threading.Lock()
+
+    def close(self):
+        """
+        Closes the LLM clients and the cache database.
+        """
+        super().close()
+        with self._db_lock:
+            self.conn.close()
+
+    @staticmethod
+    def cache_key(prompt: List[Dict[str, str]], model: str) -> bytes:
+        """
+        Returns a canonical serialization of the model and conversation: compact JSON with sorted keys,
+        so the key does not depend on the order of the keys in each message.
+        """
+        if orjson is not None:
+            return orjson.dumps([model, prompt], option=orjson.OPT_SORT_KEYS)
+        return json.dumps([model, prompt], sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def get_response(self, prompt: List[Dict[str, str]], model: str) -> str:
+        key_bytes = self.cache_key(prompt, model)
+        key_hash = hashlib.blake2b(key_bytes, digest_size=16).hexdigest()
+        prompt_str = key_bytes.decode('utf-8')
+
+        if not self.read_cache:
+            return self._request_and_store(prompt, model, key_hash, prompt_str)
+
+        content = self._lookup(key_hash)
+        if content is None:
+            with self._inflight_lock:
+                future = self._inflight.get(key_hash)
+                owner = future is None
+                if owner:
+                    future = concurrent.futures.Future()
+                    self._inflight[key_hash] = future
+
+            if owner:
+                try:
+                    # The previous owner may have stored the response between the lookup and taking ownership.
+                    content = self._lookup(key_hash)
+                    if content is None:
+                        content = self._request_and_store(prompt, model, key_hash, prompt_str)
+                        future.set_result(content)
+                        # LLMEndPoint.get_response already appended the reply to the prompt.
+                        return content
+                    future.set_result(content)
+                except BaseException as e:
+                    future.set_exception(e)
+                    raise
+                finally:
+                    with self._inflight_lock:
+                        del self._inflight[key_hash]
+            else:
+                content = future.result()
+
+        # Keep the conversation history identical to an uncached call.
+        prompt.append({"role": "assistant", "content": content})
+        return content
+
+    def _lookup(self, key_hash: str) -> Optional[str]:
+        """
+        Returns the cached response for key_hash, or None when there is none or it is older than the ttl.
+        """
+        with self._db_lock:
+            row = self.conn.execute("SELECT response, created FROM responses WHERE key = ?", (key_hash,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            return None
+        return row[0]
+
+    def _request_and_store(self, prompt: List[Dict[str, str]], model: str, key_hash: str, prompt_str: str) -> str:
+        content = super().get_response(prompt, model)
+        with self._db_lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, prompt, response, created) VALUES (?, ?, ?, ?)",
+                              (key_hash, prompt_str, content, time.time()))
+            self.conn.commit()
+        return content
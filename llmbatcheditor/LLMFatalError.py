@@ -0,0 +1,6 @@
+from llmbatcheditor.LLMRunError import LLMRunError
+
+
+class LLMFatalError(LLMRunError):
+    """LLM error that every other request would hit too, e.g. bad credentials. Stops the command instead of failing one file."""
+    pass
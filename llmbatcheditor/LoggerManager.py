@@ -1,27 +1,86 @@
 from typing import List, Dict, Any
 
 import logging
+import logging.handlers
+import os
+import queue
 from pathlib import Path
 import sys
 
 from llmbatcheditor.LLMRunError import LLMRunError
 
 
+class _LoggerRouter(logging.Handler):
+    """
+    Handler run by the QueueListener thread, it passes each record to the file handler registered for the record's logger name.
+    """
+    def __init__(self):
+        super().__init__()
+        self.routes: Dict[str, logging.Handler] = {}
+
+    def handle(self, record: logging.LogRecord):
+        handler = self.routes.get(record.name)
+        if handler is not None:
+            handler.handle(record)
+
+    def emit(self, record: logging.LogRecord):
+        self.handle(record)
+
+
 class LoggerManager:
-    """Manages logging for the application."""
+    """
+    Manages logging for the application.
+    Loggers only enqueue their records, background QueueListeners do the file and console writes.
+    Call close() when done so queued records are flushed.
+    """
 
     def __init__(self, log_dir: Path, debug: bool = False):
         self.log_dir = log_dir
         self.log_dir.mkdir(parents=True, exist_ok=True)
+        # File handlers for the per-file prompt/output logs, keyed on (command_id, file_name, kind).
+        self._handler_cache: Dict[tuple, logging.FileHandler] = {}
+
+        self._queue = queue.SimpleQueue()
+        self._queue_handler = logging.handlers.QueueHandler(self._queue)
+        self._router = _LoggerRouter()
+        self._listener = logging.handlers.QueueListener(self._queue, self._router)
+        self._listener.start()
+
         self.setup_root_logger(debug=debug)
 
+    def close(self):
+        """
+        Stops the background listeners after they have written all queued records, then closes the log files.
+        Console logging goes straight to the console handler afterwards.
+        """
+        self._listener.stop()
+        for handler in self._router.routes.values():
+            handler.close()
+        self._router.routes.clear()
+        self._handler_cache.clear()
+
+        self._console_listener.stop()
+        root = logging.getLogger()
+        if self._console_queue_handler in root.handlers:
+            root.removeHandler(self._console_queue_handler)
+            root.addHandler(self._console_handler)
+
     def setup_root_logger(self, debug: bool):
         level = logging.DEBUG if debug else logging.INFO
+        # The console gets its own queue, the command loggers propagate to the root logger and would otherwise
+        # put their records on the file queue twice.
+        self._console_handler = logging.StreamHandler(sys.stdout)
+        self._console_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+        console_queue = queue.SimpleQueue()
+        self._console_queue_handler = logging.handlers.QueueHandler(console_queue)
+        # The queue handler only merges the arguments into the message, the console handler adds the time and level.
+        self._console_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+        self._console_listener = logging.handlers.QueueListener(console_queue, self._console_handler)
+        self._console_listener.start()
         logging.basicConfig(
             level=level,
-            format="%(asctime)s [%(levelname)s] %(message)s",
             handlers=[
-                logging.StreamHandler(sys.stdout)
+                self._console_queue_handler
             ]
         )
 
@@ -32,69 +91,71 @@ class LoggerManager:
         logger = logging.getLogger(command_id)
         logger.setLevel(logging.DEBUG)
 
-        # Remove existing handlers to avoid duplicate logs
-        if logger.hasHandlers():
-            logger.handlers.clear()
-
         # Create file handler
         log_file = self.log_dir / f"{command_id}.log"
-        fh = logging.FileHandler(log_file, mode='w', encoding='utf-8')
+        fh = logging.FileHandler(log_file, mode='w', encoding='utf-8', delay=True)
         fh.setLevel(logging.DEBUG)
 
         formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
         fh.setFormatter(formatter)
-        logger.addHandler(fh)
+
+        # Close the file from an earlier run of this command.
+        previous = self._router.routes.get(command_id)
+        if previous is not None:
+            previous.close()
+        self._attach_handler(logger, fh)
 
         return logger
 
-    def setup_file_loggers(self, command_id: str, file_name: str, cycle:int = 0) -> Dict[str, logging.Logger]:
+    def setup_file_loggers(self, command_id: str, file_name: str) -> Dict[str, logging.Logger]:
         """
-        Sets up loggers for LLM prompt and output for a specific file.
-        Returns a dictionary with 'prompt' and 'output' loggers.
+        Sets up loggers for LLM prompt and output for a specific file, e.g. cmd.file.py.llm-prompt.txt.
+        Returns a dictionary with 'prompt' and 'output' loggers. Feedback edits log every retry to the same files.
         """
+        base = f"{command_id}.{file_name}"
+
+        loggers = {}
+        for kind in ("prompt", "output"):
+            file_logger = logging.getLogger(f"{base}.llm-{kind}")
+            handler = self._get_file_handler((command_id, file_name, kind), self.log_dir / f"{base}.llm-{kind}.txt")
+            self._attach_handler(file_logger, handler)
+            file_logger.propagate = False
+            loggers[kind] = file_logger
 
-        if ( cycle <= 0):
-            prompt_logger = logging.getLogger(f"{command_id}.{file_name}.llm-prompt")
-            output_logger = logging.getLogger(f"{command_id}.{file_name}.llm-output")
-        else:
-            prompt_logger = logging.getLogger(f"{command_id}.{file_name}.{cycle}.llm-prompt")
-            output_logger = logging.getLogger(f"{command_id}.{file_name}.{cycle}.llm-output")
-
-        # Remove existing handlers
-        if prompt_logger.hasHandlers():
-            prompt_logger.handlers.clear()
-        if output_logger.hasHandlers():
-            output_logger.handlers.clear()
-
-        # Prompt logger
-        if ( cycle <= 0):
-            prompt_file = self.log_dir / f"{command_id}.{file_name}.llm-prompt.txt"
-        else:
-            prompt_file = self.log_dir / f"{command_id}.{file_name}.{cycle}.llm-prompt.txt"
-            
-        ph = logging.FileHandler(prompt_file, mode='w', encoding='utf-8')
-        ph.setLevel(logging.DEBUG)
-        ph.setFormatter(logging.Formatter("%(message)s"))
-        prompt_logger.addHandler(ph)
-        prompt_logger.propagate = False
-
-        # Output logger
-        if ( cycle <= 0):
-            output_file = self.log_dir / f"{command_id}.{file_name}.llm-output.txt"
-        else:
-            output_file = self.log_dir / f"{command_id}.{file_name}.{cycle}.llm-output.txt"
-            
-        oh = logging.FileHandler(output_file, mode='w', encoding='utf-8')
-        oh.setLevel(logging.DEBUG)
-        oh.setFormatter(logging.Formatter("%(message)s"))
-        output_logger.addHandler(oh)
-        output_logger.propagate = False
-
-        return {"prompt": prompt_logger, "output": output_logger}
+        return loggers
+
+    def _get_file_handler(self, key: tuple, log_file: Path) -> logging.FileHandler:
+        """
+        Returns the cached message-only FileHandler for key, creating it on first use.
+        The handler is delayed so the file is only opened once something is logged to it.
+        """
+        handler = self._handler_cache.get(key)
+        if handler is None:
+            handler = logging.FileHandler(log_file, mode='w', encoding='utf-8', delay=True)
+            handler.setLevel(logging.DEBUG)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._handler_cache[key] = handler
+        return handler
+
+    def _attach_handler(self, logger: logging.Logger, handler: logging.Handler):
+        """
+        Makes the queue the only handler on logger and routes the logger's records to handler.
+        """
+        if logger.handlers != [self._queue_handler]:
+            logger.handlers.clear()
+            logger.addHandler(self._queue_handler)
+        self._router.routes[logger.name] = handler
 
     def delete_command_logs(self, command_id: str, file_name: str):
         """
         Deletes any log file that starts with {command_id}.{file_name}.
+        Cached handlers for those files are closed first so they don't keep writing to unlinked files.
         """
-        for log_file in self.log_dir.glob(f"{command_id}.{file_name}.*"):
-            log_file.unlink()
+        for key in [k for k in self._handler_cache if k[0] == command_id and k[1] == file_name]:
+            self._handler_cache.pop(key).close()
+
+        prefix = f"{command_id}.{file_name}."
+        with os.scandir(self.log_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefix) and entry.is_file():
+                    os.unlink(entry.path)
@@ -1,6 +1,9 @@
 from typing import List, Dict, Any
 import re
 
+# A {{macro_name}} reference, group 1 is the name.
+_MACRO_RE = re.compile(r"\{\{(\w+)\}\}")
+
 class MacroResolver:
     """Resolves macros within instructions."""
 
@@ -17,15 +20,14 @@ class MacroResolver:
                 return self.shared_prompts[macro]
             return match.group(0)  # Leave it unchanged if not a shared prompt
 
-        return re.sub(r"\{\{(\w+)\}\}", replace_shared_prompt, text.strip())
+        return _MACRO_RE.sub(replace_shared_prompt, text.strip())
 
     def resolve_placeholders(self, text: str, placeholders: Dict[str, str]) -> str:
         """
-        Replace built-in macros in the instruction text.
+        Replace built-in macros in the instruction text, in a single pass over the text.
         """
-        for key, value in placeholders.items():
-            text = text.replace(f"{{{{{key}}}}}", value.strip())
-        return text
+        stripped = {key: value.strip() for key, value in placeholders.items()}
+        return _MACRO_RE.sub(lambda match: stripped.get(match.group(1), match.group(0)), text)
 
     def resolve(self, text: str, placeholders: Dict[str, str]) -> str:
         """
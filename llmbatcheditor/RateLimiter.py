@@ -0,0 +1,88 @@
+from typing import Any, Dict, Optional
+
+import logging
+import threading
+import time
+
+# tiktoken is optional, it only makes the token estimate of OpenAI prompts exact.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# tiktoken encoder per model name, None for models tiktoken doesn't know or can't load, so each is only looked up once.
+_encoders: Dict[str, Any] = {}
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the requests per minute (rpm) and the tokens per minute (tpm) sent to the LLM.
+    Both buckets start full and refill continuously, a None limit is not enforced.
+    Shared by the worker threads, acquire() blocks until the request fits in both buckets.
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm) if rpm else 0.0
+        self._tokens = float(tpm) if tpm else 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_tokens(text: str, model: Optional[str] = None) -> int:
+        """
+        Token count of text. Exact for OpenAI models when tiktoken is installed, otherwise about four characters per token.
+        """
+        if tiktoken is not None and model is not None:
+            if model in _encoders:
+                encoding = _encoders[model]
+            else:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encoding = None
+                except Exception as e:
+                    # The BPE file is downloaded on first use, offline or with a broken cache estimate instead of failing.
+                    logging.warning(f"Could not load the tiktoken encoding for '{model}', estimating its tokens instead: {e}")
+                    encoding = None
+                _encoders[model] = encoding
+            if encoding is not None:
+                return len(encoding.encode(text, disallowed_special=()))
+        return len(text) // 4 + 1
+
+    def acquire(self, tokens: int):
+        """
+        Waits until one request of the given number of tokens is allowed, then takes it from the buckets.
+        """
+        if not self.rpm and not self.tpm:
+            return
+
+        # A single request larger than the whole bucket waits for a full bucket instead of forever.
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+
+        while True:
+            with self._lock:
+                self._refill()
+                wait = 0.0
+                if self.rpm and self._requests < 1:
+                    wait = max(wait, (1 - self._requests) * 60.0 / self.rpm)
+                if self.tpm and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60.0 / self.tpm)
+                if wait == 0.0:
+                    if self.rpm:
+                        self._requests -= 1
+                    if self.tpm:
+                        self._tokens -= tokens
+                    return
+            time.sleep(wait)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.rpm:
+            self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60.0)